@@ -1,10 +1,16 @@
 # ... (imports)
 import os
+import asyncio
 import logging
 import time
-import sqlite3
 import hashlib
-from datetime import datetime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import timedelta
+import aiosqlite
+import httpx
+from cachetools import LRUCache, TTLCache
 from telegram import Update
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 import google.generativeai as genai
@@ -14,11 +20,17 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+# httpx logs every request URL at INFO, and Telegram URLs embed the bot token
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # Configuration
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 DB_NAME = "bot_memory.db"
+MAX_FILE_SIZE = 20 * 1024 * 1024  # Bot API download limit
+# How PDFs reach Gemini: 'text' sends the extracted text layer, 'vision' the PDF file
+# (pages rendered as images), 'auto' text unless the PDF looks scanned
+PDF_HANDLING = os.getenv("PDF_HANDLING", "auto").lower()
 
 # Initialize Gemini
 if GOOGLE_API_KEY:
@@ -31,66 +43,692 @@ if GOOGLE_API_KEY:
     except Exception as e:
         print(f"Error listing models: {e}")
 
+# --- Gemini Models ---
+# Configuration for better quality
+GEN_CONFIG = genai.GenerationConfig(
+    temperature=0.3, # Lower temperature for more precise/analytical facts
+    max_output_tokens=4000 # Allow long, detailed responses
+)
+
+# Prioritize 'PRO' models for higher intelligence, then 'FLASH' for speed/backup
+TEXT_MODELS = (
+    'gemini-1.5-pro',          # Best reasoning
+    'gemini-1.5-pro-001',      # Stable reasoning
+    'gemini-2.0-flash-exp',    # New experimental (smart & fast)
+    'gemini-1.5-flash',        # Fallback
+    'gemini-1.5-flash-latest'
+)
+
+# Use Flash for audio (faster) or Pro if needed.
+# Note: Pro models handle audio very well.
+VOICE_MODELS = (
+    'gemini-1.5-flash',       # Flash is great for audio latency
+    'gemini-1.5-pro',
+    'gemini-1.5-flash-latest'
+)
+
+# Bounded pool for the blocking google-generativeai calls (upload_file/get_file have no
+# async variant; generation uses generate_content_async). Installed as the loop's default
+# executor at startup, so asyncio.to_thread runs on it.
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# One GenerativeModel per name, built on first use
+MODEL_CACHE = {}
+# Last model that answered for each candidate list, as (name, timestamp). It is tried
+# first for WORKING_MODEL_TTL seconds; after that the preferred order is retried so a
+# recovered primary model takes over again.
+WORKING_MODEL = {}
+WORKING_MODEL_TTL = 300
+
+def get_model(name):
+    if name not in MODEL_CACHE:
+        MODEL_CACHE[name] = genai.GenerativeModel(name, generation_config=GEN_CONFIG)
+    return MODEL_CACHE[name]
+
+async def generate(request_content, model_candidates, stream=False):
+    # With stream=True the fallback covers the initial request; errors while
+    # iterating the stream surface to the caller
+    working, since = WORKING_MODEL.get(model_candidates, (None, 0))
+    if working and time.time() - since < WORKING_MODEL_TTL:
+        ordered = (working,) + tuple(m for m in model_candidates if m != working)
+    else:
+        ordered = model_candidates
+
+    last_error = None
+    for model_name in ordered:
+        try:
+            response = await get_model(model_name).generate_content_async(request_content, stream=stream)
+            if model_name == model_candidates[0]:
+                WORKING_MODEL.pop(model_candidates, None)
+            elif model_name != ordered[0]:
+                # Had to fall back in this request: stick with the winner for the next window
+                WORKING_MODEL[model_candidates] = (model_name, time.time())
+            return response
+        except Exception as e:
+            logging.warning(f"Model {model_name} failed: {e}")
+            last_error = e
+    
+    raise last_error or Exception("No valid models found.")
+
+async def wait_until_processed(gemini_file, max_delay=4):
+    # Poll with exponential backoff (0.25s, 0.5s, 1s, 2s, 4s...) without blocking the event
+    # loop; small files are usually ready by the first poll
+    delay = 0.25
+    while gemini_file.state.name == "PROCESSING":
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+        gemini_file = await asyncio.to_thread(genai.get_file, gemini_file.name)
+    return gemini_file
+
 # --- Database Management ---
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# Single long-lived connection shared by every handler (opened in init_db)
+db = None
+# Hashes present in the files table; lets new uploads skip the DB lookup
+KNOWN_HASHES = set()
+# Recently used files rows, so repeat uploads of a popular PDF skip SQLite too
+FILE_CACHE = TTLCache(maxsize=1024, ttl=300)
+# Hashes being checked/uploaded right now -> Future of (gemini_id, file_ref), so
+# concurrent uploads of one PDF hit Gemini once (updates run concurrently, see __main__)
+INFLIGHT = {}
+# Hashes being re-uploaded after Gemini expired them -> Future of the new File (None on failure)
+REUPLOADS = {}
+# Ring buffer of the last HISTORY_LIMIT (role, message) rows per user; SQLite is
+# only read to warm a user's buffer, after that it is write-only durability.
+# Buffers of users idle for HIST_CACHE_TTL seconds are dropped.
+HISTORY_LIMIT = 20
+# Rows kept per user in the history table; older ones are trimmed by the trim_history trigger
+HISTORY_KEEP = 2 * HISTORY_LIMIT
+HIST_CACHE_TTL = 300
+HIST_CACHE = TTLCache(maxsize=1024, ttl=HIST_CACHE_TTL)
+MAX_STORED_MESSAGE = 4096
+# History rows waiting to be written by history_flusher
+LOG_QUEUE = asyncio.Queue()
+# Queued-but-unwritten row count per user, and the condition notified after every flush,
+# so a cold history read waits for that user's rows only
+PENDING_ROWS = {}
+HISTORY_FLUSHED = asyncio.Condition()
+# Cold history reads in progress per user; log_turn marks them stale so a read that
+# raced with a new turn retries instead of caching a buffer without it
+HISTORY_LOADS = {}
+LOG_BATCH_SIZE = 50
+LOG_FLUSH_INTERVAL = 0.2
+flusher_task = None
+# Periodic TRUNCATE checkpoint so the WAL file does not keep its high-water size
+WAL_CHECKPOINT_INTERVAL = 3600
+checkpoint_task = None
+
+# Hot-path statements, kept as constants so the same SQL text always hits
+# sqlite's per-connection prepared statement cache
+# Only whether text was extracted; the text itself is read through get_prompt_text
+SQL_SELECT_FILE = "SELECT gemini_id, file_name, extracted_text IS NOT NULL FROM files WHERE file_hash = ?"
+SQL_SELECT_FILE_TEXT = "SELECT extracted_text FROM files WHERE file_hash = ?"
+# Timestamps are filled in by SQLite rather than formatted in Python for every row
+SQL_INSERT_FILE = """INSERT OR REPLACE INTO files
+                       (file_hash, telegram_file_id, gemini_id, file_name, upload_date, extracted_text)
+                     VALUES (?, ?, ?, ?, datetime('now', 'localtime'), ?)"""
+SQL_UPDATE_FILE_TEXT = "UPDATE files SET extracted_text = ? WHERE file_hash = ?"
+SQL_SELECT_TELEGRAM_ID = "SELECT telegram_file_id FROM files WHERE file_hash = ?"
+SQL_UPDATE_FILE_GEMINI_ID = "UPDATE files SET gemini_id = ? WHERE file_hash = ?"
+SQL_UPDATE_SESSION_GEMINI_ID = "UPDATE sessions SET gemini_id = ? WHERE file_hash = ?"
+SQL_INSERT_HISTORY = """INSERT INTO history (user_id, file_hash, role, message, timestamp)
+                        VALUES (?, ?, ?, ?, datetime('now', 'localtime'))"""
+# Newest rows via the index, returned oldest-first so no reversal is needed
+SQL_SELECT_HISTORY = """SELECT role, message FROM
+                          (SELECT id, role, message FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?)
+                        ORDER BY id"""
+SQL_SELECT_SESSION = "SELECT file_hash, gemini_id, file_name FROM sessions WHERE user_id = ? ORDER BY rowid"
+SQL_INSERT_SESSION = "INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, datetime('now', 'localtime'))"
+SQL_DELETE_SESSION = "DELETE FROM sessions WHERE user_id = ?"
+
+async def init_db(app):
+    global db, flusher_task, checkpoint_task
+    asyncio.get_running_loop().set_default_executor(EXECUTOR)
+    db = await aiosqlite.connect(DB_NAME, cached_statements=256)
+    await db.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-65536;
+        PRAGMA mmap_size=268435456;
+        PRAGMA wal_autocheckpoint=1000;
+    """)
     # Table to track uploaded files
-    c.execute('''CREATE TABLE IF NOT EXISTS files
+    await db.execute('''CREATE TABLE IF NOT EXISTS files
                  (file_hash TEXT PRIMARY KEY,
                   telegram_file_id TEXT,
                   gemini_id TEXT,
                   file_name TEXT,
-                  upload_date TEXT)''')
+                  upload_date TEXT,
+                  extracted_text TEXT)''')
+    # Databases created before extracted_text existed; NULL means "not extracted yet"
+    async with db.execute("PRAGMA table_info(files)") as c:
+        if 'extracted_text' not in [row[1] for row in await c.fetchall()]:
+            await db.execute("ALTER TABLE files ADD COLUMN extracted_text TEXT")
     
     # Table to track conversation history
     # Note: 'file_hash' is kept for legacy/audit but we will query by user_id mainly
-    c.execute('''CREATE TABLE IF NOT EXISTS history
+    await db.execute('''CREATE TABLE IF NOT EXISTS history
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
                   user_id INTEGER,
                   file_hash TEXT,
                   role TEXT,
                   message TEXT,
                   timestamp TEXT)''')
-    conn.commit()
-    conn.close()
-
-def get_file_by_hash(file_hash):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT gemini_id, file_name FROM files WHERE file_hash = ?", (file_hash,))
-    result = c.fetchone()
-    conn.close()
-    return result
-
-def save_file_record(file_hash, telegram_file_id, gemini_id, file_name):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
-              (file_hash, telegram_file_id, gemini_id, file_name, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-
-def log_interaction(user_id, role, message):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("INSERT INTO history (user_id, file_hash, role, message, timestamp) VALUES (?, ?, ?, ?, ?)",
-              (user_id, 'global', role, message, datetime.now().isoformat()))
-    conn.commit()
-    conn.close()
-
-def get_chat_history(user_id, limit=20):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # Fetch global history for the user
-    c.execute("SELECT role, message FROM history WHERE user_id = ? ORDER BY id DESC LIMIT ?", 
-              (user_id, limit))
-    rows = c.fetchall()
-    conn.close()
-    return rows[::-1]
-
-# Global user session: {user_id: {'files': [{'hash': '...', 'name': '...', 'gemini_id': '...'}]}}
-user_sessions = {}
+    # Documents on each user's desk, so sessions survive restarts and TTL eviction.
+    # The primary key doubles as the user_id index.
+    await db.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (user_id INTEGER,
+                  file_hash TEXT,
+                  gemini_id TEXT,
+                  file_name TEXT,
+                  added_at TEXT,
+                  PRIMARY KEY (user_id, file_hash))''')
+    
+    # Legacy records stored the full file URI; normalize them to 'files/<id>' once
+    await db.execute("""UPDATE files SET gemini_id = 'files/' || substr(gemini_id, instr(gemini_id, '/files/') + 7)
+                        WHERE gemini_id LIKE 'https://%' AND instr(gemini_id, '/files/') > 0""")
+    # get_chat_history filters by user and walks newest-first
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_user_id ON history(user_id, id DESC)")
+    # Bounds the table per user: each insert drops whatever falls past the newest
+    # HISTORY_KEEP rows (usually one), found by the index above. Recreated on startup so
+    # a changed HISTORY_KEEP takes effect.
+    await db.execute("DROP TRIGGER IF EXISTS trim_history")
+    await db.execute(f"""CREATE TRIGGER trim_history AFTER INSERT ON history
+                         BEGIN
+                           DELETE FROM history WHERE user_id = NEW.user_id AND id <=
+                             (SELECT id FROM history WHERE user_id = NEW.user_id
+                              ORDER BY id DESC LIMIT 1 OFFSET {HISTORY_KEEP});
+                         END""")
+    await db.commit()
+
+    async with db.execute("SELECT file_hash FROM files") as c:
+        KNOWN_HASHES.update(row[0] for row in await c.fetchall())
+
+    flusher_task = asyncio.create_task(history_flusher())
+    checkpoint_task = asyncio.create_task(wal_checkpointer())
+
+async def close_db(app):
+    if checkpoint_task is not None:
+        checkpoint_task.cancel()
+    if flusher_task is not None:
+        LOG_QUEUE.put_nowait(None)
+        await flusher_task
+    if db is not None:
+        await db.close()
+
+async def wal_checkpointer():
+    while True:
+        await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
+        try:
+            await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception as e:
+            logging.warning(f"WAL checkpoint failed: {e}")
+
+async def get_file_by_hash(file_hash):
+    if file_hash not in KNOWN_HASHES:
+        return None
+    record = FILE_CACHE.get(file_hash)
+    if record is None:
+        async with db.execute(SQL_SELECT_FILE, (file_hash,)) as c:
+            record = await c.fetchone()
+        if record is not None:
+            FILE_CACHE[file_hash] = record
+    return record
+
+async def save_file_record(file_hash, telegram_file_id, gemini_id, file_name, extracted_text):
+    await db.execute(SQL_INSERT_FILE, (file_hash, telegram_file_id, gemini_id, file_name, extracted_text))
+    await db.commit()
+    KNOWN_HASHES.add(file_hash)
+    FILE_CACHE[file_hash] = (gemini_id, file_name, extracted_text is not None)
+    PROMPT_TEXTS.pop(file_hash, None)
+
+async def save_extracted_text(file_hash, extracted_text):
+    # Backfills files uploaded before text extraction (or while pdftotext was missing)
+    await db.execute(SQL_UPDATE_FILE_TEXT, (extracted_text, file_hash))
+    await db.commit()
+    FILE_CACHE.pop(file_hash, None)
+    PROMPT_TEXTS.pop(file_hash, None)
+
+def clip_message(message):
+    # History only feeds prompt context, so long messages keep their head and tail
+    if len(message) <= MAX_STORED_MESSAGE:
+        return message
+    return message[:2048] + " …[truncated]… " + message[-1024:]
+
+def log_turn(user_id, user_message, answer):
+    # Both sides of a turn are queued together; history_flusher writes them in batches
+    user_message = clip_message(user_message)
+    answer = clip_message(answer)
+    LOG_QUEUE.put_nowait((user_id, 'global', 'user', user_message))
+    LOG_QUEUE.put_nowait((user_id, 'global', 'assistant', answer))
+    PENDING_ROWS[user_id] = PENDING_ROWS.get(user_id, 0) + 2
+
+    for load in HISTORY_LOADS.get(user_id, ()):
+        load['stale'] = True
+
+    # Keep the cached history in step instead of invalidating it
+    cached = HIST_CACHE.get(user_id)
+    if cached is not None:
+        cached.append(('user', user_message))
+        cached.append(('assistant', answer))
+
+async def history_flusher():
+    # Coalesces queued history rows into one executemany + commit every
+    # LOG_FLUSH_INTERVAL seconds or LOG_BATCH_SIZE rows, whichever comes first.
+    # A None in the queue flushes what is left and stops the task. Written (or
+    # failed) rows are taken off PENDING_ROWS and waiters are woken.
+    stop = False
+    while not stop:
+        row = await LOG_QUEUE.get()
+        if row is None:
+            return
+        batch = [row]
+        if LOG_QUEUE.qsize() < LOG_BATCH_SIZE:
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        while len(batch) < LOG_BATCH_SIZE and not LOG_QUEUE.empty():
+            row = LOG_QUEUE.get_nowait()
+            if row is None:
+                stop = True
+                break
+            batch.append(row)
+
+        try:
+            await db.executemany(SQL_INSERT_HISTORY, batch)
+            await db.commit()
+        except Exception as e:
+            logging.error(f"History flush error ({len(batch)} rows lost): {e}")
+        for user_id, *_ in batch:
+            PENDING_ROWS[user_id] -= 1
+            if not PENDING_ROWS[user_id]:
+                del PENDING_ROWS[user_id]
+        async with HISTORY_FLUSHED:
+            HISTORY_FLUSHED.notify_all()
+
+async def get_chat_history(user_id, limit=HISTORY_LIMIT):
+    cached = HIST_CACHE.get(user_id)
+    while cached is None:
+        load = {'stale': False}
+        HISTORY_LOADS.setdefault(user_id, []).append(load)
+        try:
+            # An evicted buffer may still have rows in the queue; let them land first.
+            # Other users' traffic does not delay this.
+            if user_id in PENDING_ROWS:
+                async with HISTORY_FLUSHED:
+                    await HISTORY_FLUSHED.wait_for(lambda: user_id not in PENDING_ROWS)
+            # Fetch global history for the user
+            async with db.execute(SQL_SELECT_HISTORY, (user_id, HISTORY_LIMIT)) as c:
+                rows = await c.fetchall()
+        finally:
+            loads = HISTORY_LOADS[user_id]
+            loads.remove(load)
+            if not loads:
+                del HISTORY_LOADS[user_id]
+        # A concurrent read may have filled the buffer meanwhile (log_turn keeps that one
+        # current); a turn logged during this read may be missing from rows, so retry
+        cached = HIST_CACHE.get(user_id)
+        if cached is None and not load['stale']:
+            cached = deque(rows, maxlen=HISTORY_LIMIT)
+    # Re-stored on every read so the TTL counts from the user's last turn
+    HIST_CACHE[user_id] = cached
+    return list(cached)[-limit:]
+
+async def download_and_hash(url, out, chunk_size=1 << 20):
+    # Streams the Telegram download to disk and through the hasher in one pass, so
+    # the PDF is never held in memory nor read back from disk.
+    # Dedup key only, not a security primitive: BLAKE2b is faster than SHA-256 in software
+    h = hashlib.blake2b(digest_size=32)
+    try:
+        async with httpx.AsyncClient(timeout=60) as client:
+            async with client.stream('GET', url) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(chunk_size):
+                    h.update(chunk)
+                    out.write(chunk)
+    except httpx.HTTPError as e:
+        # The file URL contains the bot token, and httpx puts it in its error messages:
+        # re-raise without the URL (or the chained original) so it never reaches chat or logs
+        if isinstance(e, httpx.HTTPStatusError):
+            reason = f"HTTP {e.response.status_code}"
+        else:
+            reason = type(e).__name__
+        raise RuntimeError(f"No se pudo descargar el archivo de Telegram ({reason})") from None
+    # Readers (upload_file, pdftotext) open the file by name
+    out.flush()
+    return h.hexdigest()
+
+# --- PDF Text ---
+# In 'auto' mode a PDF goes as text only if it averages this many characters per page;
+# scanned PDFs have no text layer and stay on the vision path
+MIN_CHARS_PER_PAGE = 100
+# Prompt text per file hash (None = send the PDF file), one copy shared by every session
+# holding that document; bounded by total characters rather than entry count
+PROMPT_TEXT_BUDGET = 64 * 1024 * 1024
+PROMPT_TEXTS = LRUCache(maxsize=PROMPT_TEXT_BUDGET, getsizeof=lambda text: len(text) if text else 1)
+
+async def extract_pdf_text(path):
+    # Text layer via poppler's pdftotext, run once per new PDF and stored in the files
+    # table. Returns None when it could not run (mode 'vision', pdftotext missing or
+    # failing) so the row is retried on the next upload.
+    if PDF_HANDLING == 'vision':
+        return None
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'pdftotext', '-layout', '-enc', 'UTF-8', path, '-',
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+        out, _ = await proc.communicate()
+    except FileNotFoundError:
+        logging.warning("pdftotext not found, sending PDFs as files")
+        return None
+    if proc.returncode != 0:
+        logging.warning(f"pdftotext failed on {path} (exit {proc.returncode})")
+        return None
+    return out.decode('utf-8', errors='replace')
+
+def prompt_text(extracted_text):
+    # The text to send instead of the PDF file, or None to attach the file
+    if PDF_HANDLING == 'vision' or not extracted_text or not extracted_text.strip():
+        return None
+    if PDF_HANDLING == 'auto':
+        # pdftotext ends every page with a form feed
+        pages = extracted_text.count('\f') or 1
+        if len(extracted_text) - extracted_text.count(' ') < MIN_CHARS_PER_PAGE * pages:
+            return None
+    return extracted_text
+
+async def get_prompt_text(file_hash):
+    if PDF_HANDLING == 'vision':
+        return None
+    if file_hash in PROMPT_TEXTS:
+        return PROMPT_TEXTS[file_hash]
+    async with db.execute(SQL_SELECT_FILE_TEXT, (file_hash,)) as c:
+        row = await c.fetchone()
+    text = prompt_text(row[0]) if row else None
+    try:
+        PROMPT_TEXTS[file_hash] = text
+    except ValueError:
+        # Larger than the whole budget: served from SQLite every time
+        pass
+    return text
+
+# Global user session: {user_id: {'files': {hash: {'hash': '...', 'name': '...', 'gemini_id': '...', 'file_ref': File, 'expires_at': ts}},
+#                                  'system_instruction': '...'}}
+# 'files' is keyed by hash for O(1) duplicate checks; dict order keeps upload order
+# Idle sessions expire after SESSION_TTL seconds (load_session re-stores the session
+# on every use so the TTL counts from the last message); the sessions table is the
+# durable copy they are rebuilt from
+SESSION_TTL = 3600
+user_sessions = TTLCache(maxsize=10_000, ttl=SESSION_TTL)
+
+async def load_session(user_id):
+    # In-memory session if present, otherwise rebuilt from the sessions table
+    session = user_sessions.get(user_id)
+    if session is None:
+        async with db.execute(SQL_SELECT_SESSION, (user_id,)) as c:
+            rows = await c.fetchall()
+        if not rows:
+            return None
+        session = {'files': {}}
+        for file_hash, gemini_id, file_name in rows:
+            session['files'][file_hash] = {
+                'hash': file_hash,
+                'name': file_name,
+                'gemini_id': gemini_id,
+                'file_ref': None,
+                'expires_at': 0
+            }
+        session['system_instruction'] = build_system_instruction([f['name'] for f in session['files'].values()])
+    user_sessions[user_id] = session
+    return session
+
+async def save_session_file(user_id, file_hash, gemini_id, file_name):
+    await db.execute(SQL_INSERT_SESSION, (user_id, file_hash, gemini_id, file_name))
+    await db.commit()
+
+async def delete_session(user_id):
+    user_sessions.pop(user_id, None)
+    drop_context_cache(user_id)
+    cursor = await db.execute(SQL_DELETE_SESSION, (user_id,))
+    await db.commit()
+    return cursor.rowcount > 0
+
+# --- Prompts ---
+# Static instruction text lives here once; only the document count/list varies per session
+TEXT_SYSTEM_TEMPLATE = (
+    "Actúa como un **Experto Analista Legal Senior**. Tienes a tu disposición {count} documentos: {names}.\n"
+    "**Tu Misión:** Proveer respuestas profundas, precisas y excelentemente redactadas basándote EXCLUSIVAMENTE en la información de estos documentos.\n\n"
+    "**Directrices de Calidad:**\n"
+    "1. **Razonamiento Profundo:** No te limites a citar. Analiza la intención, el contexto y las implicaciones de lo que lees.\n"
+    "2. **Síntesis Cruzada:** Si la respuesta abarca varios documentos, integra la información de forma fluida. No listes documentos por separado a menos que sea necesario para comparar.\n"
+    "3. **Estilo Profesional:** Usa un tono formal, claro y jurídico. Estructura tu respuesta con títulos, viñetas y párrafos bien formados.\n"
+    "4. **Honestidad Intelectual:** Si la información no está en los documentos, dilo claramente. No inventes.\n"
+    "5. **Cero Metadatos:** Entrega solo la respuesta final, lista para ser usada en un informe oficial."
+)
+
+VOICE_SYSTEM_TEMPLATE = (
+    "Eres un experto analista legal. El usuario te ha enviado una NOTA DE VOZ con instrucciones o preguntas.\n"
+    "Contexto documental: {count} archivos ({names}).\n"
+    "**Tu Misión:** Escucha el audio atentamente y responde a la solicitud del usuario usando la información de los documentos.\n"
+    "Si el audio pide un resumen, hazlo. Si hace una pregunta específica, respóndela.\n"
+    "Mantén la misma calidad 'Experto Senior' que en texto escrito."
+)
+
+# Line prefix of each stored history role in the prompt
+ROLE_LABELS = {'user': "U: ", 'assistant': "A: "}
+
+def build_system_instruction(file_names, template=TEXT_SYSTEM_TEMPLATE):
+    return template.format(count=len(file_names), names=', '.join(file_names))
+
+def file_ref_expiry(file_ref):
+    # Gemini deletes uploaded files after 48h; stop trusting a cached handle an hour before
+    expiration = getattr(file_ref, 'expiration_time', None)
+    if expiration is not None:
+        return expiration.timestamp() - 3600
+    return time.time() + 47 * 3600
+
+async def refresh_file_ref(file_data, bot):
+    # A handle cannot be renewed: get_file returns the same expiration_time. So the
+    # current name from the files table (another session may have re-uploaded already)
+    # is used while it has more than an hour left; otherwise the PDF goes to Gemini again.
+    record = await get_file_by_hash(file_data['hash'])
+    gemini_id = record[0] if record else file_data['gemini_id']
+    try:
+        file_ref = await asyncio.to_thread(genai.get_file, gemini_id)
+        if time.time() < file_ref_expiry(file_ref):
+            return file_ref
+    except Exception as e:
+        logging.info(f"Gemini file {gemini_id} unavailable: {e}")
+    return await reupload_file(file_data['hash'], file_data['name'], bot)
+
+async def reupload_file(file_hash, file_name, bot):
+    # Downloads the PDF again by its stored Telegram file_id and re-uploads it; concurrent
+    # callers for the same hash share one upload
+    pending = REUPLOADS.get(file_hash)
+    if pending is not None:
+        file_ref = await asyncio.shield(pending)
+        if file_ref is None:
+            raise RuntimeError(f"No se pudo volver a subir {file_name} a Gemini")
+        return file_ref
+
+    future = REUPLOADS[file_hash] = asyncio.get_running_loop().create_future()
+    file_ref = None
+    try:
+        async with db.execute(SQL_SELECT_TELEGRAM_ID, (file_hash,)) as c:
+            row = await c.fetchone()
+        if row is None:
+            raise RuntimeError(f"No hay copia de {file_name} en Telegram")
+        logging.info(f"Re-uploading expired file {file_name}")
+        telegram_file = await bot.get_file(row[0])
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp:
+            await download_and_hash(telegram_file.file_path, tmp)
+            gemini_file = await asyncio.to_thread(genai.upload_file, path=tmp.name, display_name=file_name,
+                                                  mime_type='application/pdf')
+        gemini_file = await wait_until_processed(gemini_file)
+        if gemini_file.state.name == "FAILED":
+            raise RuntimeError(f"Gemini no pudo procesar {file_name}")
+
+        await db.execute(SQL_UPDATE_FILE_GEMINI_ID, (gemini_file.name, file_hash))
+        await db.execute(SQL_UPDATE_SESSION_GEMINI_ID, (gemini_file.name, file_hash))
+        await db.commit()
+        FILE_CACHE.pop(file_hash, None)
+        file_ref = gemini_file
+        return file_ref
+    finally:
+        del REUPLOADS[file_hash]
+        future.set_result(file_ref)
+
+async def attach_session_files(session, bot):
+    # Gemini File refs are fetched once per session file and reused until /clear or expiry.
+    # Missing/expired refs are fetched (or the PDF re-uploaded) concurrently. Files sent
+    # as text need no ref.
+    files = list(session['files'].values())
+    texts = await asyncio.gather(*(get_prompt_text(f['hash']) for f in files))
+    now = time.time()
+    stale = [f for f, text in zip(files, texts)
+             if text is None and (f['file_ref'] is None or now >= f['expires_at'])]
+    results = await asyncio.gather(*(refresh_file_ref(f, bot) for f in stale), return_exceptions=True)
+    for file_data, result in zip(stale, results):
+        if isinstance(result, Exception):
+            logging.error(f"Error attaching file {file_data['name']}: {result}")
+            file_data['file_ref'] = None
+        else:
+            file_data['gemini_id'] = result.name
+            file_data['file_ref'] = result
+            file_data['expires_at'] = file_ref_expiry(result)
+
+    request_content = []
+    file_names = []
+    
+    for file_data, text in zip(files, texts):
+        if text is not None:
+            request_content.append(f"--- Documento: {file_data['name']} ---\n{text}")
+            file_names.append(file_data['name'])
+        elif file_data['file_ref'] is not None:
+            request_content.append(file_data['file_ref'])
+            file_names.append(file_data['name'])
+    
+    return request_content, file_names
+
+# --- Context Caching ---
+# The session's documents and system instruction go into a Gemini context cache once, so
+# text turns only send history + question. A cache is bound to one model version and
+# Gemini rejects contexts below its minimum size (32k tokens on 1.5 models); those
+# sessions keep using generate() with the documents attached.
+CACHE_MODEL = 'models/gemini-1.5-pro-001'
+CONTEXT_CACHE_TTL = SESSION_TTL
+# Cache handles per user, held apart from user_sessions so a session rebuilt after TTL
+# eviction reuses its live cache instead of paying for a second one. Entries expire a
+# minute before Gemini drops the cache; a handle lost to size eviction only leaves the
+# cache to expire on its own.
+CONTEXT_CACHES = TTLCache(maxsize=10_000, ttl=CONTEXT_CACHE_TTL - 60)
+# Fire-and-forget tasks, referenced until done so they are not garbage-collected mid-run
+BACKGROUND_TASKS = set()
+
+async def get_cached_model(user_id, session, request_content, system_instruction):
+    # Model bound to a cache of the current document list, or None. Failed creations
+    # are remembered too, so small sessions do not retry on every turn. The entry is
+    # stored before the cache is created, so overlapping turns of one user await the
+    # same creation instead of each paying for a cache.
+    key = tuple(session['files'])
+    entry = CONTEXT_CACHES.get(user_id)
+    if entry is not None and entry['key'] == key:
+        return await asyncio.shield(entry['model'])
+    drop_context_cache(user_id)
+
+    entry = {'key': key, 'cache': None, 'model': asyncio.get_running_loop().create_future()}
+    CONTEXT_CACHES[user_id] = entry
+    model = None
+    try:
+        cache = await asyncio.to_thread(genai.caching.CachedContent.create, model=CACHE_MODEL,
+                                        system_instruction=system_instruction, contents=request_content,
+                                        ttl=timedelta(seconds=CONTEXT_CACHE_TTL))
+        if CONTEXT_CACHES.get(user_id) is entry:
+            entry['cache'] = cache
+            model = genai.GenerativeModel.from_cached_content(cache, generation_config=GEN_CONFIG)
+        else:
+            # The document list changed (or /clear ran) while creating: nobody owns this cache
+            schedule_cache_delete(cache)
+    except Exception as e:
+        logging.info(f"Context cache not created: {e}")
+    finally:
+        entry['model'].set_result(model)
+    return model
+
+async def delete_context_cache(cache):
+    try:
+        await asyncio.to_thread(cache.delete)
+    except Exception as e:
+        logging.warning(f"Context cache delete failed: {e}")
+
+def schedule_cache_delete(cache):
+    task = asyncio.get_running_loop().create_task(delete_context_cache(cache))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+def drop_context_cache(user_id):
+    # Deletes the user's cache in the background instead of paying for it until it expires.
+    # An entry still being created is deleted by its creator (see get_cached_model).
+    entry = CONTEXT_CACHES.pop(user_id, None)
+    if entry is not None and entry['cache'] is not None:
+        schedule_cache_delete(entry['cache'])
+
+# --- Telegram Output ---
+MAX_MESSAGE_LENGTH = 4000
+# Minimum seconds between edits of a message that is still streaming (Telegram rate-limits edits)
+STREAM_EDIT_INTERVAL = 1.5
+
+async def send_markdown(message, text):
+    try:
+        return await message.reply_text(text, parse_mode='Markdown')
+    except Exception as e:
+        logging.warning(f"Markdown failed, sending plain text: {e}")
+        return await message.reply_text(text, parse_mode=None)
+
+async def finish_markdown(sent, text, shown):
+    # Final edit of a streamed message: Markdown if it parses, else plain text
+    try:
+        await sent.edit_text(text, parse_mode='Markdown')
+    except Exception as e:
+        logging.warning(f"Markdown failed, keeping plain text: {e}")
+        if text != shown:
+            await sent.edit_text(text, parse_mode=None)
+
+async def stream_reply(message, response, placeholder=None):
+    # Relays a streamed Gemini response as it arrives: the last Telegram message is
+    # edited (debounced) while it grows, and a new one starts every MAX_MESSAGE_LENGTH
+    # characters. Returns the full answer.
+    parts = []
+    current = ""
+    sent = placeholder
+    shown = placeholder.text if placeholder else ""
+    last_edit = 0.0
+
+    async for chunk in response:
+        parts.append(chunk.text)
+        current += chunk.text
+
+        while len(current) > MAX_MESSAGE_LENGTH:
+            head, current = current[:MAX_MESSAGE_LENGTH], current[MAX_MESSAGE_LENGTH:]
+            if sent is None:
+                await send_markdown(message, head)
+            else:
+                await finish_markdown(sent, head, shown)
+            sent, shown = None, ""
+
+        if current and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            if sent is None:
+                sent = await message.reply_text(current, parse_mode=None)
+            elif current != shown:
+                await sent.edit_text(current, parse_mode=None)
+            shown = current
+            last_edit = time.monotonic()
+
+    if current:
+        if sent is None:
+            await send_markdown(message, current)
+        else:
+            await finish_markdown(sent, current, shown)
+
+    return "".join(parts)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -112,63 +750,92 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if document.mime_type != 'application/pdf':
         await msg.edit_text("Solo acepto archivos PDF por ahora.")
         return
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        await msg.edit_text("El archivo supera el límite de 20 MB que Telegram permite descargar a los bots.")
+        return
+
+    # The download is the only copy of the PDF: hashed and uploaded from here. The file
+    # is deleted when tmp is closed in finally.
+    tmp = tempfile.NamedTemporaryFile(suffix='.pdf')
+    temp_path = tmp.name
+    inflight = None
 
     try:
-        # 1. Download and Hash
+        # 1. Download to disk and hash in chunks (constant memory)
         file_obj = await context.bot.get_file(document.file_id)
-        file_content = await file_obj.download_as_bytearray()
-        
-        file_hash = hashlib.sha256(file_content).hexdigest()
+        file_hash = await download_and_hash(file_obj.file_path, tmp)
         file_name = document.file_name
 
-        # 2. Check DB for Deduplication
-        existing_record = get_file_by_hash(file_hash)
-        
+        # 2. Check DB for Deduplication. The first handler to see a hash claims it in
+        # INFLIGHT; concurrent handlers for the same PDF await its result instead.
         gemini_id = None
+        file_ref = None
+        existing_record = None
+
+        pending = INFLIGHT.get(file_hash)
+        if pending is None:
+            inflight = INFLIGHT[file_hash] = asyncio.get_running_loop().create_future()
+            existing_record = await get_file_by_hash(file_hash)
         
-        if existing_record:
-            gemini_id, stored_name = existing_record
+        if pending is not None:
+            # Shielded: a cancelled waiter must not cancel the Future the uploader resolves
+            shared = await asyncio.shield(pending)
+            if shared is None:
+                await msg.edit_text("Error: Gemini no pudo procesar el PDF.")
+                return
+            gemini_id, file_ref = shared
+            await msg.edit_text(f"¡Ya conozco este documento ({file_name})! Agregándolo a tu escritorio... 🧠")
+        elif existing_record:
+            gemini_id, stored_name, has_text = existing_record
             await msg.edit_text(f"¡Ya conozco este documento ({stored_name})! Agregándolo a tu escritorio... 🧠")
+            if not has_text:
+                extracted_text = await extract_pdf_text(temp_path)
+                if extracted_text is not None:
+                    await save_extracted_text(file_hash, extracted_text)
         else:
             await msg.edit_text(f"Documento nuevo. Subiendo a Gemini... 🚀")
             
-            # Save temp file
-            temp_path = f"temp_{file_hash}.pdf"
-            with open(temp_path, "wb") as f:
-                f.write(file_content)
-            
-            gemini_file = genai.upload_file(path=temp_path, display_name=file_name)
+            # The file is still uploaded: scanned PDFs, and text-mode fallback, need it
+            gemini_file, extracted_text = await asyncio.gather(
+                asyncio.to_thread(genai.upload_file, path=temp_path, display_name=file_name,
+                                  mime_type='application/pdf'),
+                extract_pdf_text(temp_path))
             
             # Wait for processing
-            while gemini_file.state.name == "PROCESSING":
-                time.sleep(2)
-                gemini_file = genai.get_file(gemini_file.name)
+            gemini_file = await wait_until_processed(gemini_file)
             
             if gemini_file.state.name == "FAILED":
                 await msg.edit_text("Error: Gemini no pudo procesar el PDF.")
-                if os.path.exists(temp_path): os.remove(temp_path)
                 return
 
             gemini_id = gemini_file.name 
-            save_file_record(file_hash, document.file_id, gemini_id, file_name)
-            
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+            file_ref = gemini_file
+            await save_file_record(file_hash, document.file_id, gemini_id, file_name, extracted_text)
+
+        if inflight is not None:
+            del INFLIGHT[file_hash]
+            inflight.set_result((gemini_id, file_ref))
+            inflight = None
 
         # 3. Add to Session List
         user_id = update.effective_user.id
-        if user_id not in user_sessions:
-            user_sessions[user_id] = {'files': []}
+        session = await load_session(user_id)
+        if session is None:
+            session = user_sessions[user_id] = {'files': {}}
         
         # Avoid adding duplicates to the active session list
-        if not any(f['hash'] == file_hash for f in user_sessions[user_id]['files']):
-            user_sessions[user_id]['files'].append({
+        if file_hash not in session['files']:
+            session['files'][file_hash] = {
                 'hash': file_hash,
                 'name': file_name,
-                'gemini_id': gemini_id
-            })
-
-        count = len(user_sessions[user_id]['files'])
+                'gemini_id': gemini_id,
+                'file_ref': file_ref,
+                'expires_at': file_ref_expiry(file_ref) if file_ref else 0
+            }
+            session['system_instruction'] = build_system_instruction([f['name'] for f in session['files'].values()])
+            await save_session_file(user_id, file_hash, gemini_id, file_name)
+
+        count = len(session['files'])
         await msg.edit_text(
             f"✅ **{file_name}** agregado.\n"
             f"📂 Tienes **{count}** documentos en tu escritorio.\n"
@@ -178,12 +845,18 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         logging.error(f"Error: {e}")
         await msg.edit_text(f"Error crítico: {e}")
+    finally:
+        if inflight is not None:
+            # Upload failed: waiters get None and report the error too
+            del INFLIGHT[file_hash]
+            inflight.set_result(None)
+        tmp.close()
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text
     
-    session = user_sessions.get(user_id)
+    session = await load_session(user_id)
     if not session or not session.get('files'):
         await update.message.reply_text("Tu escritorio está vacío. Sube al menos un PDF primero.")
         return
@@ -192,116 +865,50 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         logging.info("--- Processing Multi-File Query ---")
-        history = get_chat_history(user_id)
-        log_interaction(user_id, 'user', text)
+        history = await get_chat_history(user_id)
         
         # Prepare content list: [file1, file2, ..., prompt]
-        request_content = []
-        file_names = []
-        
-        for file_data in session['files']:
-            try:
-                # Resolve Name
-                gemini_id = file_data.get('gemini_id')
-                if gemini_id and "https://" in gemini_id and "/files/" in gemini_id:
-                     gemini_id = "files/" + gemini_id.split("/files/")[-1]
-                
-                f_obj = genai.get_file(gemini_id)
-                request_content.append(f_obj)
-                file_names.append(file_data['name'])
-            except Exception as e:
-                logging.error(f"Error attaching file {file_data['name']}: {e}")
+        request_content, file_names = await attach_session_files(session, context.bot)
         
         if not request_content:
             await update.message.reply_text("Error: No pude recuperar los archivos de Gemini. Intenta /clear y resubir.")
             return
 
-        system_instruction = (
-            f"Actúa como un **Experto Analista Legal Senior**. Tienes a tu disposición {len(file_names)} documentos: {', '.join(file_names)}.\n"
-            "**Tu Misión:** Proveer respuestas profundas, precisas y excelentemente redactadas basándote EXCLUSIVAMENTE en la información de estos documentos.\n\n"
-            "**Directrices de Calidad:**\n"
-            "1. **Razonamiento Profundo:** No te limites a citar. Analiza la intención, el contexto y las implicaciones de lo que lees.\n"
-            "2. **Síntesis Cruzada:** Si la respuesta abarca varios documentos, integra la información de forma fluida. No listes documentos por separado a menos que sea necesario para comparar.\n"
-            "3. **Estilo Profesional:** Usa un tono formal, claro y jurídico. Estructura tu respuesta con títulos, viñetas y párrafos bien formados.\n"
-            "4. **Honestidad Intelectual:** Si la información no está en los documentos, dilo claramente. No inventes.\n"
-            "5. **Cero Metadatos:** Entrega solo la respuesta final, lista para ser usada en un informe oficial."
-        )
-        
-        chat_context = []
-        for role, msg in history:
-            chat_context.append(f"{'U' if role == 'user' else 'A'}: {msg}")
+        # Built once per change of the document list (see handle_document); rebuilt
+        # here only if some file could not be attached
+        system_instruction = session.get('system_instruction')
+        if system_instruction is None or len(file_names) != len(session['files']):
+            system_instruction = build_system_instruction(file_names)
         
-        full_prompt = (
-            f"{system_instruction}\n"
-            "--- Historial de Conversación ---\n" + "\n".join(chat_context) + "\n"
-            "---------------------------------\n"
-            f"**CONSULTA DEL CLIENTE:** {text}\n"
+        # One list, one join: no intermediate strings for the history block
+        prompt_parts = ["--- Historial de Conversación ---"]
+        prompt_parts.extend(ROLE_LABELS[role] + msg for role, msg in history)
+        prompt_parts += [
+            "---------------------------------",
+            f"**CONSULTA DEL CLIENTE:** {text}",
             "**RESPUESTA DEL EXPERTO:**"
-        )
-
-        request_content.append(full_prompt)
-
-        # Prioritize 'PRO' models for higher intelligence, then 'FLASH' for speed/backup
-        model_candidates = [
-            'gemini-1.5-pro',          # Best reasoning
-            'gemini-1.5-pro-001',      # Stable reasoning
-            'gemini-2.0-flash-exp',    # New experimental (smart & fast)
-            'gemini-1.5-flash',        # Fallback
-            'gemini-1.5-flash-latest'
         ]
+        turn_prompt = "\n".join(prompt_parts)
 
+        # Cached documents + instruction when every file is attached; otherwise, or if
+        # the cached model fails, the documents are sent along with the prompt
         response = None
-        used_model = None
-        last_error = None
-
-        # Configuration for better quality
-        gen_config = genai.GenerationConfig(
-            temperature=0.3, # Lower temperature for more precise/analytical facts
-            max_output_tokens=4000 # Allow long, detailed responses
-        )
+        if len(file_names) == len(session['files']):
+            cached_model = await get_cached_model(user_id, session, request_content, system_instruction)
+            if cached_model is not None:
+                try:
+                    response = await cached_model.generate_content_async(turn_prompt, stream=True)
+                except Exception as e:
+                    logging.warning(f"Cached model failed: {e}")
 
-        for model_name in model_candidates:
-            try:
-                model = genai.GenerativeModel(model_name, generation_config=gen_config)
-                response = model.generate_content(request_content)
-                used_model = model_name
-                break
-            except Exception as e:
-                logging.warning(f"Model {model_name} failed: {e}")
-                last_error = e
-        
-        if not response:
-            raise last_error or Exception("No valid models found.")
+        if response is None:
+            request_content.append(system_instruction + "\n" + turn_prompt)
+            response = await generate(request_content, TEXT_MODELS, stream=True)
 
         # Clean answer, no metadata appended
-        answer = response.text 
-        
-        log_interaction(user_id, 'assistant', answer)
+        answer = await stream_reply(update.message, response)
         
-        if not response:
-            raise last_error or Exception("No valid models found.")
-
-        # Clean answer, no metadata appended
-        answer = response.text 
-        
-        log_interaction(user_id, 'assistant', answer)
-        
-        # Helper to send long messages
-        async def send_long_message(text):
-            MAX_LENGTH = 4000
-            for i in range(0, len(text), MAX_LENGTH):
-                chunk = text[i:i+MAX_LENGTH]
-                try:
-                    await update.message.reply_text(chunk, parse_mode='Markdown')
-                except Exception as e:
-                    logging.warning(f"Markdown failed for chunk {i}, sending plain text: {e}")
-                    await update.message.reply_text(chunk, parse_mode=None)
-
-        try:
-             await send_long_message(answer)
-        except Exception as e:
-            logging.error(f"Send Error: {e}")
-            await update.message.reply_text("Error enviando la respuesta completa.")
+        log_turn(user_id, text, answer)
 
     except Exception as e:
         logging.error(f"Generation Error: {e}")
@@ -310,137 +917,80 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
-    session = user_sessions.get(user_id)
+    session = await load_session(user_id)
     if not session or not session.get('files'):
         await update.message.reply_text("Primero sube un PDF para que pueda analizar tus instrucciones de voz.")
         return
 
     msg = await update.message.reply_text("🎙️ Escuchando y analizando... 🧠")
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='upload_voice')
+    # Once the answer streams into msg, errors must not overwrite it
+    streaming = False
 
     try:
         # 1. Download Audio
         voice_file = await context.bot.get_file(update.message.voice.file_id)
         voice_data = await voice_file.download_as_bytearray()
         
-        # Save temp ogg
-        timestamp = int(time.time())
-        temp_audio_path = f"voice_{user_id}_{timestamp}.ogg"
-        with open(temp_audio_path, "wb") as f:
-            f.write(voice_data)
-
-        # 2. Upload to Gemini
-        gemini_audio = genai.upload_file(path=temp_audio_path, mime_type='audio/ogg')
+        # 2. Upload to Gemini from a temp ogg, deleted as soon as the upload is done
+        with tempfile.NamedTemporaryFile(suffix='.ogg') as tmp:
+            tmp.write(voice_data)
+            tmp.flush()
+            gemini_audio = await asyncio.to_thread(genai.upload_file, path=tmp.name, mime_type='audio/ogg')
         
         # Wait for processing (usually instant for audio, but safe legacy check)
-        while gemini_audio.state.name == "PROCESSING":
-            time.sleep(1)
-            gemini_audio = genai.get_file(gemini_audio.name)
+        gemini_audio = await wait_until_processed(gemini_audio)
 
         # 3. Prepare Context (PDFs + Audio)
-        request_content = []
-        file_names = []
-        
-        for file_data in session['files']:
-            try:
-                gemini_id = file_data.get('gemini_id')
-                if gemini_id and "https://" in gemini_id and "/files/" in gemini_id:
-                     gemini_id = "files/" + gemini_id.split("/files/")[-1]
-                
-                f_obj = genai.get_file(gemini_id)
-                request_content.append(f_obj)
-                file_names.append(file_data['name'])
-            except Exception as e:
-                logging.error(f"Error attaching file {file_data['name']}: {e}")
+        request_content, file_names = await attach_session_files(session, context.bot)
 
         # Add Audio File
         request_content.append(gemini_audio)
         
         # 4. Prompt
-        system_instruction = (
-            f"Eres un experto analista legal. El usuario te ha enviado una NOTA DE VOZ con instrucciones o preguntas.\n"
-            f"Contexto documental: {len(file_names)} archivos ({', '.join(file_names)}).\n"
-            "**Tu Misión:** Escucha el audio atentamente y responde a la solicitud del usuario usando la información de los documentos.\n"
-            "Si el audio pide un resumen, hazlo. Si hace una pregunta específica, respóndela.\n"
-            "Mantén la misma calidad 'Experto Senior' que en texto escrito."
-        )
+        system_instruction = build_system_instruction(file_names, VOICE_SYSTEM_TEMPLATE)
         
         # Fetch history (optional, maybe keep it simple for voice for now, or include it)
-        history = get_chat_history(user_id)
-        chat_context = [f"{'U' if role == 'user' else 'A'}: {msg}" for role, msg in history]
-        
-        full_prompt = (
-            f"{system_instruction}\n"
-            "--- Historial Reciente ---\n" + "\n".join(chat_context) + "\n"
-            "--------------------------\n"
+        history = await get_chat_history(user_id)
+        prompt_parts = [system_instruction, "--- Historial Reciente ---"]
+        prompt_parts.extend(ROLE_LABELS[role] + msg for role, msg in history)
+        prompt_parts += [
+            "--------------------------",
             "**INSTRUCCIÓN DE AUDIO:** (Ver archivo de audio adjunto)\n"
-        )
+        ]
+        full_prompt = "\n".join(prompt_parts)
         request_content.append(full_prompt)
 
         # 5. Generate
-        gen_config = genai.GenerationConfig(temperature=0.3, max_output_tokens=4000)
-        
-        # Use Flash for audio (faster) or Pro if needed. Let's try candidates.
-        # Note: Pro models handle audio very well.
-        model_candidates = [
-            'gemini-1.5-flash',       # Flash is great for audio latency
-            'gemini-1.5-pro',
-            'gemini-1.5-flash-latest'
-        ]
+        response = await generate(request_content, VOICE_MODELS, stream=True)
 
-        response = None
-        last_error = None
-
-        for model_name in model_candidates:
-            try:
-                model = genai.GenerativeModel(model_name, generation_config=gen_config)
-                response = model.generate_content(request_content)
-                break
-            except Exception as e:
-                logging.warning(f"Voice Model {model_name} failed: {e}")
-                last_error = e
-        
-        if not response:
-            raise last_error or Exception("No valid models found for audio.")
-
-        answer = response.text
-        
-        # Cleanup
-        if os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
+        # Send: the "Listening..." message becomes the first chunk of the answer
+        streaming = True
+        answer = await stream_reply(update.message, response, placeholder=msg)
             
         # Log (placeholder text for voice)
-        log_interaction(user_id, 'user', '[NOTA DE VOZ]')
-        log_interaction(user_id, 'assistant', answer)
-
-        # Send
-        await msg.delete() # Remove "Listening..." message
-        
-        # Use helper logic (inline here for simplicity or reuse if Refactored, I'll copy the helper logic briefly)
-        MAX_LEGTH = 4000
-        for i in range(0, len(answer), MAX_LEGTH):
-            chunk = answer[i:i+MAX_LEGTH]
-            try:
-                await update.message.reply_text(chunk, parse_mode='Markdown')
-            except:
-                await update.message.reply_text(chunk, parse_mode=None)
+        log_turn(user_id, '[NOTA DE VOZ]', answer)
 
     except Exception as e:
         logging.error(f"Voice Error: {e}")
-        await msg.edit_text(f"Error procesando audio: {e}")
+        if streaming:
+            await update.message.reply_text(f"Error procesando audio: {e}")
+        else:
+            await msg.edit_text(f"Error procesando audio: {e}")
 
 async def clear(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.effective_user.id in user_sessions:
-        del user_sessions[update.effective_user.id]
+    if await delete_session(update.effective_user.id):
         await update.message.reply_text("Sesión limpiada.")
     else:
         await update.message.reply_text("Nada que limpiar.")
 
 if __name__ == '__main__':
-    init_db()
     if not TELEGRAM_TOKEN: exit("No Token")
     
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Updates are handled concurrently (up to 32 at once, matching EXECUTOR) so one user's
+    # upload or streamed answer does not hold up everyone else
+    app = (ApplicationBuilder().token(TELEGRAM_TOKEN).concurrent_updates(32)
+           .post_init(init_db).post_shutdown(close_db).build())
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CommandHandler('clear', clear))
     app.add_handler(MessageHandler(filters.Document.PDF, handle_document))
@@ -1,7 +1,41 @@
 import os
+import sys
+import json
+import time
+import hashlib
 import google.generativeai as genai
 
-def diagnose():
+# list_models() results are cached per API key for a day; run with --refresh to skip the cache
+# Kept in the user's cache directory, not in the repo checkout
+MODELS_CACHE_FILE = os.path.join(os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                 "telegram-notebooklm-bot", "models.json")
+MODELS_CACHE_TTL = 24 * 3600
+
+def list_models(api_key, refresh=False):
+    # Returns [{'name', 'version', 'methods'}], from the cache file if fresh
+    key_id = hashlib.blake2b(api_key.encode(), digest_size=8).hexdigest()
+    try:
+        with open(MODELS_CACHE_FILE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    entry = cache.get(key_id)
+    if not refresh and entry and time.time() - entry['fetched_at'] < MODELS_CACHE_TTL:
+        return entry['models']
+
+    models = [{'name': m.name, 'version': m.version, 'methods': list(m.supported_generation_methods)}
+              for m in genai.list_models()]
+    cache[key_id] = {'fetched_at': time.time(), 'models': models}
+    try:
+        os.makedirs(os.path.dirname(MODELS_CACHE_FILE), exist_ok=True)
+        with open(MODELS_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"(No se pudo guardar la caché de modelos: {e})")
+    return models
+
+def diagnose(refresh=False):
     print("--- Diagnóstico de Modelos de Gemini ---")
     
     # 1. Get Key
@@ -21,15 +55,15 @@ def diagnose():
     # 3. List Models
     print(f"\n🔍 Consultando lista de modelos disponibles para tu cuenta...")
     try:
-        models = list(genai.list_models())
+        models = list_models(api_key, refresh)
         print(f"✅ Se encontraron {len(models)} modelos.")
         
         print("\n📋 Modelos que soportan 'generateContent' (Texto/Chat):")
         found_flash = False
         for m in models:
-            if 'generateContent' in m.supported_generation_methods:
-                print(f"   • {m.name} (Versión: {m.version})")
-                if 'flash' in m.name:
+            if 'generateContent' in m['methods']:
+                print(f"   • {m['name']} (Versión: {m['version']})")
+                if 'flash' in m['name']:
                     found_flash = True
         
         if not found_flash:
@@ -43,4 +77,4 @@ def diagnose():
         print("Esto suele significar que la API Key no es válida, o no tiene permisos, o es de un proyecto de Google Cloud (Vertex AI) en lugar de AI Studio.")
 
 if __name__ == "__main__":
-    diagnose()
+    diagnose(refresh='--refresh' in sys.argv)